@@ -19,7 +19,6 @@ import torch
 import math
 import kymatio.datasets as scattering_datasets
 import numpy as np
-from parametricSN.utils.helpers import countLearnableParams
 from parametricSN.utils.helpers import get_context, visualize_loss
 from parametricSN.utils.helpers import visualize_learning_rates
 from parametricSN.utils.helpers import  log_mlflow, getSimplePlot
@@ -31,6 +30,7 @@ from parametricSN.data_loading.dataset_factory import datasetFactory
 from parametricSN.visualization.viewer import filterVisualizer
 
 from parametricSN.models.models_factory import topModelFactory, baseModelFactory
+from parametricSN.models.sn_top_models import check_compile, compile_model, countLearnableParams
 from parametricSN.models.sn_hybrid_models import sn_HybridModel
 from parametricSN.training.training_factory import train_test_factory
 
@@ -67,6 +67,9 @@ def run_train(args):
     params = get_context(args.param_file) #parse params
     params = override_params(args,params) #override from CLI
 
+    if params['model'].get('compile'): #fail before loading any data
+        check_compile()
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     DATA_DIR = get_data_root(params['dataset']['name'], params['dataset']['data_root'], params['dataset']['data_folder'])
@@ -109,10 +112,14 @@ def run_train(args):
         architecture=params['model']['name'],
         num_classes=params['dataset']['num_classes'], 
         width= params['model']['width'], 
+        channels_last=device.type == 'cuda', #NHWC conv kernels only pay off on GPU
     )
 
     hybridModel = sn_HybridModel(scatteringBase=scatteringBase, top=top).to(device) #create hybrid model
 
+    if params['model'].get('compile'): #let inductor fuse the linear/conv epilogues of the top model
+        compile_model(top, mode=params['model']['compile'])
+
     optimizer = optimizerFactory(hybridModel=hybridModel, params=params)
 
     #use gradient accumulation if VRAM is constrained
@@ -196,6 +203,9 @@ def run_train(args):
     else:
         compareParamsVisualization = None
 
+    if params['model'].get('compile'):
+        del top.forward #compiled forwards cannot be pickled by mlflow
+
     #MLFLOW logging below
     f_loss = visualize_loss(
         train_losses, test_losses, step_test=params['model']['step_test'], 
@@ -312,6 +322,7 @@ def main():
     subparser.add_argument("--model-step-test", "-mst", type=int)
     subparser.add_argument("--model-loss", "-mloss", type=str, choices=['cosine', 'cross-entropy','cross-entropy-accum'])
     subparser.add_argument("--model-save", "-msave", type=int, choices=[0,1])
+    subparser.add_argument("--model-compile", "-mcomp", type=str, choices=['default', 'reduce-overhead', 'max-autotune'])
 
     subparser.add_argument('--param_file', "-pf", type=str, default='parameters.yml',
                         help="YML Parameter File Name")
@@ -61,22 +61,28 @@ def baseModelFactory(architecture, J, N, M, second_order, initialization, seed,
 
 
 
-def topModelFactory(base, architecture, num_classes, width=8, average=False):
+def topModelFactory(base, architecture, num_classes, width=8, average=False, channels_last=False):
     """Factory for the creation of seconds part of a hybrid model
     
     parameters:
-        base         -- (Pytorch nn.Module) the first part of a hybrid model
-        architecture -- the name of the top model to select
-        num_classes  -- number of classes in dataset
-        width        -- the width of the model
-        average      -- boolean indicating whether to average the spatial information 
-                        of the scattering coefficients
+        base          -- (Pytorch nn.Module) the first part of a hybrid model
+        architecture  -- the name of the top model to select
+        num_classes   -- number of classes in dataset
+        width         -- the width of the model
+        average       -- boolean indicating whether to average the spatial information 
+                         of the scattering coefficients
+        channels_last -- boolean indicating whether convolutional models should use 
+                         the NHWC memory format (only worthwhile on GPU)
     """
 
     if architecture.lower() == 'cnn':
-        return sn_CNN(
-            base.n_coefficients, k=width, num_classes=num_classes, standard=False
+        top = sn_CNN(
+            base.n_coefficients, k=width, num_classes=num_classes, standard=False,
+            channels_last=channels_last
         )
+        if hasattr(base, 'M_coefficient'): #scattering output size is known ahead of time
+            top.specialize_for_input(int(base.M_coefficient), int(base.N_coefficient))
+        return top
 
     elif architecture.lower() == 'mlp':
         return sn_MLP(
@@ -91,7 +97,7 @@ def topModelFactory(base, architecture, num_classes, width=8, average=False):
         )
 
     elif architecture.lower() == 'resnet50':
-        return sn_Resnet50(num_classes=num_classes)
+        return sn_Resnet50(num_classes=num_classes, channels_last=channels_last)
 
     else:
         print("In modelFactory() incorrect module name for architecture={}".format(architecture))
@@ -4,6 +4,11 @@ Authors: Benjamin Therien, Shanel Gauthier
 
 Functions: 
     conv3x3              -- 3x3 convolution with padding
+    conv1x1              -- 1x1 convolution
+    freeze_for_inference -- scripts and freezes a model for fast inference
+    check_compile        -- raises an error when torch.compile is unavailable
+    compile_model        -- compiles the forward pass of a model with torch.compile
+    relu_dropout         -- scripted ReLU followed by dropout
     countLearnableParams -- returns the amount of learnable parameters in this model
 
 Classes: 
@@ -11,12 +16,20 @@ Classes:
     sn_LinearLayer -- Linear layer fitted for scattering input
     sn_MLP         -- Multilayer perceptron fitted for scattering input
     BasicBlock     -- Standard wideresnet basicblock
+    ChannelsLastMixin -- Optional NHWC memory format for convolutional models
+    ChannelPad     -- Parameter free shortcut zero padding the channels of its input
+    ConvReLU       -- Conv2d followed by a ReLU, run as a single cuDNN call on GPU
+    Float32Linear  -- Linear layer casting its input to float32
     Resnet50       --Pretrained resnet-50 on ImageNet
 """
 
 from torchvision import models
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.fx.experimental.optimization import fuse as fuse_fx
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class sn_MLP(nn.Module):
@@ -26,11 +39,16 @@ class sn_MLP(nn.Module):
     def __init__(self, num_classes=10, n_coefficients=81, M_coefficient=8, N_coefficient=8):
         super(sn_MLP,self).__init__()
         self.num_classes = num_classes
+        self.n_coefficients = n_coefficients
+        self.M_coefficient = int(M_coefficient)
+        self.N_coefficient = int(N_coefficient)
 
-        fc1 =  nn.Linear(int(3*M_coefficient*N_coefficient*n_coefficients), 512)
+        n_features = int(3*M_coefficient*N_coefficient*n_coefficients)
+        fc1 =  nn.Linear(n_features, 512)
 
         self.layers = nn.Sequential(
-            nn.BatchNorm2d(self.n_coefficients*3, eps=1e-5, affine=True),
+            nn.Flatten(),
+            nn.BatchNorm1d(n_features, eps=1e-5, affine=True),
             fc1,
             nn.ReLU(),
             nn.Linear(512, 256),
@@ -41,11 +59,38 @@ class sn_MLP(nn.Module):
             nn.ReLU(),
             nn.Linear(64, num_classes)
         )
+        self.layers_dtype = torch.float32
 
     def forward(self, x):
         """Forward pass"""
-        x = x.view(x.shape[0], -1)
-        return self.layers(x)
+        return self.layers(x.to(self.layers_dtype)).float()
+
+    def fuse_for_inference(self):
+        """folds the input batchnorm into fc1, call in eval mode only"""
+        if isinstance(self.layers[1], nn.BatchNorm1d):
+            _fuse_bn_linear(self.layers[1], self.layers[2])
+            self.layers[1] = nn.Identity()
+        return self
+
+    def quantize_for_inference(self, dtype=torch.qint8):
+        """lowers the precision of the linear layers for inference, call in eval mode only
+
+        torch.qint8 dynamically quantizes fc1, which holds nearly all the weights 
+        (CPU only). A floating point dtype such as torch.bfloat16 casts every 
+        linear layer instead (GPU). The input batchnorm is folded into fc1 first.
+        Compare test accuracy before and after to measure the impact.
+
+        parameters:
+            dtype -- torch.qint8 or the floating point dtype to cast to
+        """
+        self.fuse_for_inference()
+        if dtype == torch.qint8:
+            fc1 = next(name for name, m in self.layers.named_children() if isinstance(m, nn.Linear))
+            self.layers = torch.ao.quantization.quantize_dynamic(self.layers, {fc1}, dtype=dtype)
+        else:
+            self.layers = self.layers.to(dtype)
+            self.layers_dtype = dtype
+        return self
 
 
 def conv3x3(in_planes, out_planes, stride=1):
@@ -60,6 +105,111 @@ def conv1x1(in_planes, out_planes, stride=1):
                     bias=False)
 
 
+def countLearnableParams(model):
+    """returns the amount of learnable parameters in model, frozen ones are not counted"""
+    return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+def freeze_for_inference(model):
+    """returns a scripted and frozen copy of model for inference
+
+    Freezing lets the JIT fold batchnorms into convs and fuse the pointwise 
+    ops that follow them. Training should keep using the eager model.
+    """
+    frozen = torch.jit.freeze(torch.jit.script(model.eval()))
+    return torch.jit.optimize_for_inference(frozen)
+
+
+def check_compile():
+    """raises a RuntimeError when this torch version has no torch.compile"""
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError("torch.compile requires torch>=2.0, found torch {}".format(torch.__version__))
+
+
+def compile_model(model, mode="reduce-overhead", **kwargs):
+    """compiles the forward pass of model in place with torch.compile and returns model
+
+    Inductor fuses the chains of pointwise ops (ReLU, residual add, dropout) 
+    between convs into single kernels. Run with TORCH_LOGS=+inductor to 
+    inspect the generated kernels. The compiled forward cannot be pickled, 
+    `del model.forward` restores the eager one before saving.
+
+    parameters:
+        model  -- the nn.Module to compile
+        mode   -- the torch.compile mode
+        kwargs -- other arguments passed to torch.compile
+    """
+    check_compile()
+    model.forward = torch.compile(model.forward, mode=mode, **kwargs)
+    return model
+
+
+@torch.jit.script
+def relu_dropout(x, p: float, training: bool):
+    """ReLU followed by dropout, scripted so both pointwise ops can be fused"""
+    return F.dropout(F.relu(x, inplace=True), p=p, training=training)
+
+
+def _fuse_conv_bn(conv, bn):
+    """returns conv with the eval mode batchnorm bn folded into it, and an identity to replace bn
+    
+    Does nothing if bn has already been fused.
+    """
+    if isinstance(bn, nn.BatchNorm2d):
+        return fuse_conv_bn_eval(conv, bn), nn.Identity()
+    return conv, bn
+
+
+def _fuse_bn_linear(bn, fc, spatial_size=1):
+    """folds the eval mode batchnorm bn into fc, the linear layer consuming its flattened output
+
+    parameters:
+        bn           -- the batchnorm applied before flattening
+        fc           -- the linear layer applied after flattening
+        spatial_size -- number of flattened positions covered by each batchnorm channel
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        #channels vary slowest once flattened
+        scale = scale.repeat_interleave(spatial_size)
+        shift = shift.repeat_interleave(spatial_size)
+        fc.bias += fc.weight @ shift
+        fc.weight *= scale[None, :]
+
+
+def _fuse_conv_bn_sequential(sequential):
+    """folds every batchnorm directly following a conv in sequential into that conv"""
+    for i in range(len(sequential) - 1):
+        if isinstance(sequential[i], nn.Conv2d):
+            sequential[i], sequential[i+1] = _fuse_conv_bn(sequential[i], sequential[i+1])
+
+
+class ChannelsLastMixin(object):
+    """
+    Optional NHWC memory format for convolutional nn.Modules, tracked by self.channels_last
+    """
+    def __setstate__(self, state):
+        state.setdefault('channels_last', False) #modules pickled before the option existed
+        super(ChannelsLastMixin, self).__setstate__(state)
+
+    def to_channels_last(self):
+        """converts the conv weights to NHWC so cuDNN can use its channels_last kernels"""
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
+    def _reapply_channels_last(self):
+        """converts layers replaced since to_channels_last was called, returns self"""
+        if self.channels_last:
+            self.to_channels_last()
+        return self
+
+    def _format_input(self, x):
+        """permutes x to the memory format of the model"""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
 
 class BasicBlock(nn.Module):
     """
@@ -88,18 +238,54 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        out = F.relu(out + residual)
 
         return out
 
+    def fuse_for_inference(self):
+        """folds bn1, bn2 and the downsample batchnorm into their convs, call in eval mode only"""
+        self.conv1, self.bn1 = _fuse_conv_bn(self.conv1, self.bn1)
+        self.conv2, self.bn2 = _fuse_conv_bn(self.conv2, self.bn2)
+        if self.downsample is not None:
+            _fuse_conv_bn_sequential(self.downsample)
+        return self
+
+
+class ConvReLU(nn.Module):
+    """
+    Conv2d followed by a ReLU, run as a single cuDNN call on GPU
+    """
+    def __init__(self, conv):
+        super(ConvReLU, self).__init__()
+        self.weight = conv.weight
+        self.bias = conv.bias
+        self.stride = list(conv.stride)
+        self.padding = list(conv.padding)
+        self.dilation = list(conv.dilation)
+        self.groups = conv.groups
+
+    @torch.jit.unused
+    def _cudnn_usable(self, x):
+        """checks that cuDNN can run the fused call on x"""
+        return x.is_cuda and torch.backends.cudnn.is_available() and torch.backends.cudnn.enabled
+
+    def forward(self, x):
+        #scripted models take the plain path, freezing fuses it back on GPU
+        if not torch.jit.is_scripting() and self._cudnn_usable(x):
+            return torch.cudnn_convolution_relu(
+                x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups
+            )
+        return F.relu(F.conv2d(
+            x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups
+        ))
+
 
-class sn_CNN(nn.Module):
+class sn_CNN(ChannelsLastMixin, nn.Module):
     """
     CNN fitted for scattering input
     Model from: https://github.com/kymatio/kymatio/blob/master/examples/2d/cifar_small_sample.py 
     """
-    def __init__(self, in_channels, k=8, n=4, num_classes=10, standard=False):
+    def __init__(self, in_channels, k=8, n=4, num_classes=10, standard=False, channels_last=False):
         super(sn_CNN, self).__init__()
 
         self.bn0 = nn.BatchNorm2d(in_channels*3,eps=1e-5,affine=True)
@@ -122,12 +308,12 @@ class sn_CNN(nn.Module):
         else:
             self.K = in_channels
             self.init_conv = nn.Sequential(
-                nn.BatchNorm2d(in_channels, eps=1e-5, affine=False),
                 nn.Conv2d(in_channels, self.ichannels,
                       kernel_size=3, stride=1, padding=1, bias=False),
                 nn.BatchNorm2d(self.ichannels),
                 nn.ReLU(True)
             )
+            self.layer1 = None
             self.standard = False
 
         self.layer2 = self._make_layer(BasicBlock, 32 * k, n)
@@ -135,6 +321,70 @@ class sn_CNN(nn.Module):
         self.avgpool = nn.AdaptiveAvgPool2d(2)
         self.fc = nn.Linear(64 * k * 4, num_classes)
 
+        self.channels_last = False
+        if channels_last:
+            self.to_channels_last()
+
+    def __setstate__(self, state):
+        if 'layer1' not in state['_modules']: #non-standard models pickled before layer1 was set to None
+            state.setdefault('layer1', None)
+        super(sn_CNN, self).__setstate__(state)
+
+    def fuse_for_inference(self):
+        """folds every conv-batchnorm pair into a single conv, call in eval mode only
+        
+        bn0 is kept: it precedes a zero padded conv, so folding it in would not be exact.
+        The fused stem conv and its ReLU are replaced by a single ConvReLU, unless the stem
+        was pickled with another layout (e.g. the batchnorm preceding the conv in older models).
+        """
+        if isinstance(self.init_conv, nn.Sequential):
+            _fuse_conv_bn_sequential(self.init_conv)
+            if [type(m) for m in self.init_conv] == [nn.Conv2d, nn.Identity, nn.ReLU]:
+                self.init_conv = ConvReLU(self.init_conv[0])
+        for block in [m for m in self.modules() if isinstance(m, BasicBlock)]:
+            block.fuse_for_inference()
+        return self._reapply_channels_last()
+
+    def build_inference_graph(self, example_input):
+        """captures the fused forward pass in a CUDA graph and returns a function replaying it
+
+        All the kernels of a forward pass are then launched at once. Inputs must have 
+        the shape of example_input, and the returned output is overwritten by the next call.
+
+        parameters:
+            example_input -- a CUDA batch shaped like the inference inputs
+        """
+        self.eval()
+        self.fuse_for_inference()
+        static_input = example_input.clone()
+
+        stream = torch.cuda.Stream() #warm up on a side stream before capturing
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            self(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph):
+            static_output = self(static_input)
+
+        def replay(x):
+            static_input.copy_(x)
+            graph.replay()
+            return static_output
+
+        return replay
+
+    def specialize_for_input(self, H, W):
+        """replaces the adaptive average pooling with a fixed one for H x W inputs
+
+        No layer downsamples, so the pooled feature map is H x W. Nothing is 
+        changed when it does not split evenly into 2 x 2 bins.
+        """
+        if H % 2 == 0 and W % 2 == 0:
+            self.avgpool = nn.AvgPool2d(kernel_size=(H // 2, W // 2))
+        return self
+
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes:
@@ -152,16 +402,15 @@ class sn_CNN(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        if not self.standard:
-            pass
+        x = self._format_input(x)
         x = self.bn0(x)
         x = self.init_conv(x)
-        if self.standard:
+        if self.layer1 is not None:
             x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = torch.flatten(x, 1)
         x = self.fc(x)
         return x
 
@@ -174,6 +423,8 @@ class sn_LinearLayer(nn.Module):
         super(sn_LinearLayer, self).__init__()
         self.n_coefficients = n_coefficients
         self.num_classes = num_classes
+        self.M_coefficient = int(M_coefficient)
+        self.N_coefficient = int(N_coefficient)
 
         self.fc1 = nn.Linear(int(3*M_coefficient*N_coefficient*n_coefficients), num_classes)
         self.bn0 = nn.BatchNorm2d(self.n_coefficients*3, eps=1e-5, affine=True)
@@ -184,27 +435,101 @@ class sn_LinearLayer(nn.Module):
         x = self.fc1(x)
         return x
 
+    def fuse_for_inference(self):
+        """folds bn0 into fc1, call in eval mode only"""
+        if isinstance(self.bn0, nn.BatchNorm2d):
+            #spatial size from the shapes, models pickled before it was stored lack M and N
+            _fuse_bn_linear(self.bn0, self.fc1, self.fc1.in_features // self.bn0.num_features)
+            self.bn0 = nn.Identity()
+        return self
+
+
+class Float32Linear(nn.Linear):
+    """
+    Linear layer casting its input to float32, ends a reduced precision backbone
+    """
+    def forward(self, x):
+        return F.linear(x.float(), self.weight, self.bias)
+
 
-class sn_Resnet50(nn.Module):
+class sn_Resnet50(ChannelsLastMixin, nn.Module):
     """
     Pretrained model on ImageNet
     Architecture: ResNet-50
+
+    parameters:
+        num_classes     -- number of classes in dataset
+        channels_last   -- boolean indicating whether to use the NHWC memory format,
+                           recommended with a reduced precision dtype on Tensor Core GPUs
+        pretrained      -- boolean indicating whether to download the ImageNet weights
+        dtype           -- dtype of the backbone, the final fc always stays in float32
+        freeze_backbone -- boolean indicating whether to only train the final fc
     """
-    def __init__(self, num_classes=10):
+    def __init__(self, num_classes=10, channels_last=False, pretrained=True, 
+                 dtype=torch.float32, freeze_backbone=False):
         super(sn_Resnet50, self).__init__()
-        self.model_ft = models.resnet50(pretrained=True)
+        self.model_ft = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1 if pretrained else None)
         num_ftrs = self.model_ft.fc.in_features
         self.model_ft.fc =  nn.Linear(num_ftrs, num_classes)
         self.num_classes = num_classes
+        self.backbone_dtype = dtype
+        self.freeze_backbone = freeze_backbone
+
+        if dtype != torch.float32:
+            self.model_ft.to(dtype=dtype)
+            self.model_ft.fc = Float32Linear(num_ftrs, num_classes)
+
+        #frozen weights get no gradients nor optimizer state, autograd still runs through 
+        #the backbone to reach the learnable scattering filters
+        if freeze_backbone:
+            for name, p in self.model_ft.named_parameters():
+                if not name.startswith('fc.'):
+                    p.requires_grad_(False)
+            self.train()
+
+        self.channels_last = False
+        if channels_last:
+            self.to_channels_last()
+
+    def __setstate__(self, state):
+        state.setdefault('backbone_dtype', torch.float32) #models pickled before these options
+        state.setdefault('freeze_backbone', False)
+        super(sn_Resnet50, self).__setstate__(state)
+
+    def train(self, mode=True):
+        """sets the training mode, a frozen backbone keeps its batchnorm statistics fixed"""
+        super(sn_Resnet50, self).train(mode)
+        if self.freeze_backbone:
+            self.model_ft.eval()
+            self.model_ft.fc.train(mode)
+        return self
+
+    def fuse_for_inference(self):
+        """traces the backbone with torch.fx and folds its conv-batchnorm pairs, call in eval mode only"""
+        self.model_ft = fuse_fx(self.model_ft, inplace=True)
+        return self._reapply_channels_last()
 
     def forward(self, x):
-        x = self.model_ft(x)
+        x = self._format_input(x)
+        x = self.model_ft(x.to(self.backbone_dtype))
         return x
 
 
 
+class ChannelPad(nn.Module):
+    """
+    Parameter free shortcut zero padding the channels of its input from inplanes to planes
+    """
+    def __init__(self, inplanes, planes):
+        super(ChannelPad, self).__init__()
+        self.pad = planes - inplanes
+
+    def forward(self, x):
+        return F.pad(x, (0, 0, 0, 0, 0, self.pad))
+
+
 class BasicBlockWRN16_8(nn.Module):
-    def __init__(self, inplanes, planes, dropout, stride=1):
+    def __init__(self, inplanes, planes, dropout, stride=1, pad_shortcut=False):
         super(BasicBlockWRN16_8, self).__init__()
         self.bn1 = nn.BatchNorm2d(inplanes)
         self.conv1 = conv3x3(inplanes, planes, stride)
@@ -212,17 +537,23 @@ class BasicBlockWRN16_8(nn.Module):
         self.bn2 = nn.BatchNorm2d(planes)
         self.conv2 = conv3x3(planes, planes)
         self.relu = nn.ReLU(inplace=True)
-        if stride != 1 or inplanes != planes:
+        if stride == 1 and inplanes < planes and pad_shortcut:
+            self.shortcut = ChannelPad(inplanes, planes)
+        elif stride != 1 or inplanes != planes:
             self.shortcut = conv1x1(inplanes, planes, stride)
-            self.use_conv1x1 = True
         else:
-            self.use_conv1x1 = False
+            self.shortcut = None
+
+    def __setstate__(self, state):
+        if 'shortcut' not in state['_modules']: #identity shortcut blocks pickled before it was set to None
+            state.setdefault('shortcut', None)
+        super(BasicBlockWRN16_8, self).__setstate__(state)
 
     def forward(self, x):
         out = self.bn1(x)
         out = self.relu(out)
 
-        if self.use_conv1x1:
+        if self.shortcut is not None:
             shortcut = self.shortcut(out)
         else:
             shortcut = x
@@ -230,24 +561,32 @@ class BasicBlockWRN16_8(nn.Module):
         out = self.conv1(out)
 
         out = self.bn2(out)
-        out = self.relu(out)
-        out = self.dropout(out)
+        out = relu_dropout(out, self.dropout.p, self.training)
         out = self.conv2(out)
 
-        out += shortcut
+        out = out + shortcut
 
         return out
 
+    def fuse_for_inference(self):
+        """folds bn2 into conv1, call in eval mode only
+        
+        bn1 feeds a ReLU before reaching any conv, so it cannot be folded.
+        """
+        self.conv1, self.bn2 = _fuse_conv_bn(self.conv1, self.bn2)
+        return self
+
 
 
-class WideResNet16_8(nn.Module):
+class WideResNet16_8(ChannelsLastMixin, nn.Module):
     """WRN-16-8 from https://arxiv.org/abs/1605.07146"""
-    def __init__(self, depth, width, num_classes=10, dropout=0.3):
+    def __init__(self, depth, width, num_classes=10, dropout=0.3, channels_last=False, pad_shortcut=False):
         super(WideResNet16_8, self).__init__()
 
         layer = (depth - 4) // 6
 
         self.inplanes = 16
+        self.pad_shortcut = pad_shortcut
         self.conv = conv3x3(3, 16)
         self.layer1 = self._make_layer(16*width, layer, dropout)
         self.layer2 = self._make_layer(32*width, layer, dropout, stride=2)
@@ -257,19 +596,40 @@ class WideResNet16_8(nn.Module):
         self.avgpool = nn.AdaptiveAvgPool2d(1)
         self.fc = nn.Linear(64*width, num_classes)
 
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                m.weight.data = nn.init.kaiming_normal_(m.weight.data, mode='fan_out', nonlinearity='relu')
+        with torch.no_grad():
+            for m in self.modules():
+                if isinstance(m, nn.Conv2d):
+                    nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+
+        self.channels_last = False
+        if channels_last:
+            self.to_channels_last()
+
+    def fuse_for_inference(self):
+        """folds every conv-batchnorm pair into a single conv, call in eval mode only"""
+        for block in [m for m in self.modules() if isinstance(m, BasicBlockWRN16_8)]:
+            block.fuse_for_inference()
+        return self._reapply_channels_last()
+
+    def specialize_for_input(self, H, W):
+        """replaces the adaptive average pooling with a fixed one for H x W inputs"""
+        for _ in range(2): #layer2 and layer3 each halve the resolution
+            H, W = (H + 1) // 2, (W + 1) // 2
+        self.avgpool = nn.AvgPool2d(kernel_size=(H, W))
+        return self
 
     def _make_layer(self, planes, blocks, dropout, stride=1):
         layers = []
         for i in range(blocks):
-            layers.append(BasicBlockWRN16_8(self.inplanes, planes, dropout, stride if i == 0 else 1))
+            layers.append(BasicBlockWRN16_8(
+                self.inplanes, planes, dropout, stride if i == 0 else 1, pad_shortcut=self.pad_shortcut
+            ))
             self.inplanes = planes
 
         return nn.Sequential(*layers)
 
     def forward(self, x):
+        x = self._format_input(x)
         x = self.conv(x)
 
         x = self.layer1(x)
@@ -279,14 +639,11 @@ class WideResNet16_8(nn.Module):
         x = self.bn(x)
         x = self.relu(x)
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = torch.flatten(x, 1)
         x = self.fc(x)
 
         return x
         
     def countLearnableParams(self):
         """returns the amount of learnable parameters in this model"""
-        count = 0
-        for t in self.parameters():
-            count += t.numel()
-        return count
\ No newline at end of file
+        return countLearnableParams(self)
\ No newline at end of file